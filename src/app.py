@@ -1,9 +1,11 @@
+import asyncio
+from collections.abc import Mapping
 from contextlib import asynccontextmanager, closing
+from dataclasses import dataclass, replace
 import logging
 from pathlib import Path
 import threading
-from functools import wraps
-from multiprocessing import Pool
+from functools import lru_cache, wraps
 from urllib.parse import quote
 
 import pymupdf
@@ -12,27 +14,75 @@ from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from jinja2 import FileSystemBytecodeCache
 
 from config import config
 from scanner import (
     ScanOptions,
     list_scanners,
+    load_cached_scanners,
+    save_cached_scanners,
     scan,
-    scanners as global_scanner_dict,
     isBusy,
+    SaneScanner,
     SaneType,
 )
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global snapshot
+    if (cached_scanners := load_cached_scanners()) is not None:
+        # serve the scanners found during the last run right away
+        snapshot = replace(snapshot, scanners=cached_scanners)
+        probe = update_scanners
+    else:
+        # nothing to show yet, clients get the progress page until the
+        # scanners have been found
+        snapshot = replace(snapshot, scan_list_update=True)
+        probe = update_scanlist
+    # probing SANE blocks for a while, so it runs in a worker thread while the
+    # app is already serving requests
+    refresh = asyncio.create_task(asyncio.to_thread(probe))
+    refresh.add_done_callback(log_probe_error)
+    yield
+    refresh.cancel()
+
+
+def log_probe_error(task: asyncio.Task):
+    if not task.cancelled() and (e := task.exception()) is not None:
+        logger.error("searching for scanners failed", exc_info=e)
+
+
+logger = logging.getLogger(__name__)
+app = FastAPI(lifespan=lifespan)
 app.mount("/static", StaticFiles(directory="static"), name="static")
 globals_lock = threading.Lock()
 sane_lock = threading.Lock()
 
 templates = Jinja2Templates(directory="templates")
-templates.env.filters["uriquote"] = lambda x: quote(str(x)) if x else ""
-
-scan_list_update = False
-has_front = set()
+# the templates don't change while the app is running, so skip the mtime check
+# on every render and keep the compiled templates across restarts
+templates.env.auto_reload = False
+templates.env.bytecode_cache = FileSystemBytecodeCache()
+# the filter is applied to the same few device names on every poll
+cached_quote = lru_cache(maxsize=256)(quote)
+templates.env.filters["uriquote"] = lambda x: cached_quote(str(x)) if x else ""
+# values that are the same for every render
+templates.env.globals["SANE_TYPE"] = SaneType
+templates.env.globals["config"] = config
+
+
+@dataclass(frozen=True, slots=True)
+class Snapshot:
+    # State read by the polling endpoints. Writers replace the whole snapshot
+    # while holding globals_lock, readers take a reference once and never lock.
+    scanners: Mapping[str, SaneScanner]
+    scan_list_update: bool = False
+    has_front: frozenset[str] = frozenset()
+
+
+snapshot = Snapshot(scanners={})
 last_scan_options: dict[str, ScanOptions] = {}
 last_scan_filenames: dict[str, Path] = {}
 
@@ -44,7 +94,7 @@ def using_sane(f):
         try:
             return f(*args, **kwargs)
         finally:
-            print("disconnecting sane")
+            logger.debug("disconnecting sane")
             sane.exit()
 
     return wrapper
@@ -60,7 +110,7 @@ def busy_device(devicename: str):
             try:
                 return f(*args, **kwargs)
             finally:
-                print(f"releasing {devicename}")
+                logger.debug("releasing %s", devicename)
                 isBusy.remove(devicename)
 
         return wrapper
@@ -70,17 +120,18 @@ def busy_device(devicename: str):
 
 @app.get("/", response_class=HTMLResponse)
 async def root(request: Request):
-    for scanner_name, scanner in global_scanner_dict.items():
-        logging.info(f"{scanner_name}: {scanner}")
-    with globals_lock:
-        return templates.TemplateResponse(
-            request=request,
-            name="index.html",
-            context={
-                "scanners": global_scanner_dict,
-                "scan_list_update": scan_list_update,
-            },
-        )
+    snap = snapshot
+    if logger.isEnabledFor(logging.DEBUG):
+        for scanner_name, scanner in snap.scanners.items():
+            logger.debug("%s: %s", scanner_name, scanner)
+    return templates.TemplateResponse(
+        request=request,
+        name="index.html",
+        context={
+            "scanners": snap.scanners,
+            "scan_list_update": snap.scan_list_update,
+        },
+    )
 
 
 @app.get("/list_scanners", response_class=HTMLResponse)
@@ -89,13 +140,14 @@ def get_scanners(request: Request, background_tasks: BackgroundTasks):
     return templates.TemplateResponse(
         request=request,
         name="updating_scanners.html",
-        context={"scanners": global_scanner_dict},
+        context={"scanners": snapshot.scanners},
     )
 
 
 @app.get("/scanner_update_status", response_class=HTMLResponse)
 def get_scanlist_update_status(request: Request):
-    if scan_list_update:
+    snap = snapshot
+    if snap.scan_list_update:
         return templates.TemplateResponse(
             request=request, name="updating_scanners.html"
         )
@@ -103,48 +155,49 @@ def get_scanlist_update_status(request: Request):
         return templates.TemplateResponse(
             request=request,
             name="scanner_home.html",
-            context={"scanners": global_scanner_dict},
+            context={"scanners": snap.scanners},
         )
 
 
 def update_scanlist():
-    global scan_list_update
+    global snapshot
     with globals_lock:
-        scan_list_update = True
-
-    update_scanners()
+        snapshot = replace(snapshot, scan_list_update=True)
 
-    with globals_lock:
-        scan_list_update = False
+    try:
+        update_scanners()
+    finally:
+        with globals_lock:
+            snapshot = replace(snapshot, scan_list_update=False)
 
 
 def update_scanners():
-    global global_scanner_dict
+    global snapshot
 
     @using_sane
     def do_list_scanners():
         return list_scanners()
 
-    logging.info("searching for scanners...")
+    logger.info("searching for scanners...")
     with sane_lock:
         r = do_list_scanners()
     with globals_lock:
-        global_scanner_dict = r
-    logging.debug("scanner list updated")
+        snapshot = replace(snapshot, scanners=r)
+    save_cached_scanners(r)
+    logger.debug("scanner list updated")
 
 
 @app.get("/isBusy/{scanner_name:path}", response_class=HTMLResponse)
 async def is_busy(request: Request, scanner_name: str):
     global isBusy
-    global has_front
-    print(f"busy scanners: {isBusy}")
-    with globals_lock:
-        scanner = global_scanner_dict[scanner_name]
+    logger.debug("busy scanners: %s", isBusy)
+    snap = snapshot
+    scanner = snap.scanners[scanner_name]
     if scanner_name in isBusy:
         return templates.TemplateResponse(
             request=request, name="scanning.html", context={"scanner": scanner}
         )
-    elif scanner.device_name in has_front:
+    elif scanner.device_name in snap.has_front:
         return templates.TemplateResponse(
             request=request, name="scan_backside.html", context={"scanner": scanner}
         )
@@ -152,28 +205,27 @@ async def is_busy(request: Request, scanner_name: str):
         return templates.TemplateResponse(
             request=request,
             name="scanoptions.html",
-            context={"scanner": scanner, "SANE_TYPE": SaneType, "config": config},
+            context={"scanner": scanner},
         )
 
 
 @app.get("/scanner/{scanner_name:path}", response_class=HTMLResponse)
 def get_scan_site(request: Request, scanner_name: str):
-    scanner = global_scanner_dict[scanner_name]
+    snap = snapshot
+    scanner = snap.scanners[scanner_name]
     return templates.TemplateResponse(
         request=request,
         name="scanpage.html",
         context={
             "scanner": scanner,
-            "SANE_TYPE": SaneType,
-            "has_front": scanner.device_name in has_front,
+            "has_front": scanner.device_name in snap.has_front,
             "isBusy": isBusy,
-            "config": config,
         },
     )
 
 
 def perform_scan(data: ScanOptions):
-    global has_front, last_scan_options
+    global snapshot, last_scan_options
 
     @using_sane
     @busy_device(data.scanner)
@@ -183,15 +235,15 @@ def perform_scan(data: ScanOptions):
     with sane_lock:
         target = do_scan(data)
     if target:
-        logging.info("scan completed")
+        logger.info("scan completed")
         with globals_lock:
             last_scan_options[data.scanner] = data
             last_scan_filenames[data.scanner] = target
-            has_front.add(data.scanner)
+            snapshot = replace(snapshot, has_front=snapshot.has_front | {data.scanner})
         return target
 
 def add_backside(data: ScanOptions):
-    global has_front, last_scan_filenames
+    global snapshot, last_scan_filenames
     if not (frontside_file := last_scan_filenames.get(data.scanner)):
         raise FileExistsError("no front side defined")
     data.filename = f"{frontside_file.name}_backside.pdf"
@@ -202,17 +254,18 @@ def add_backside(data: ScanOptions):
             front := pymupdf.open(frontside_file)
         ), closing(back := pymupdf.open(backside_file)):
             if front.page_count != back.page_count:
-                logging.error("page numbers don't match, skipping")
+                logger.error("page numbers don't match, skipping")
             else:
-                for (n, front_page), (o, back_page) in zip(
-                    enumerate(front.pages()), reversed(list(enumerate(back.pages())))
-                ):
+                # the backside pages were scanned in reverse order
+                n_pages = front.page_count
+                for n in range(n_pages):
+                    o = n_pages - 1 - n
                     result.insert_pdf(front, from_page=n, to_page=n)
                     result.insert_pdf(back, from_page=o, to_page=o)
                 result.save(frontside_file)
         backside_file.unlink()
         with globals_lock:
-            has_front.discard(data.scanner)
+            snapshot = replace(snapshot, has_front=snapshot.has_front - {data.scanner})
             last_scan_filenames.pop(data.scanner)
 
 
@@ -221,16 +274,16 @@ async def start_scan(
     request: Request, data: ScanOptions, background_tasks: BackgroundTasks
 ):
     # global isBusy
-    logging.debug(data)
+    logger.debug("%s", data)
     background_tasks.add_task(perform_scan, data)
-    scanner = global_scanner_dict[data.scanner]
+    snap = snapshot
+    scanner = snap.scanners[data.scanner]
     return templates.TemplateResponse(
         request=request,
         name="scanning.html",
         context={
             "scanner": scanner,
-            "SANE_TYPE": SaneType,
-            "has_front": scanner.device_name in has_front,
+            "has_front": scanner.device_name in snap.has_front,
             "isBusy": isBusy,
         },
     )
@@ -240,31 +293,27 @@ async def start_scan(
 async def backside_scan(
     request: Request, scanner_name: str, background_tasks: BackgroundTasks
 ):
-    with globals_lock:
-        scanner = global_scanner_dict[scanner_name]
-        background_tasks.add_task(add_backside, last_scan_options[scanner.device_name])
-        return templates.TemplateResponse(
-            request=request,
-            name="scanning.html",
-            context={
-                "scanner": scanner,
-            },
-        )
+    scanner = snapshot.scanners[scanner_name]
+    background_tasks.add_task(add_backside, last_scan_options[scanner.device_name])
+    return templates.TemplateResponse(
+        request=request,
+        name="scanning.html",
+        context={
+            "scanner": scanner,
+        },
+    )
 
 
 @app.post("/done/{scanner_name:path}", response_class=HTMLResponse)
 async def reset_front(request: Request, scanner_name: str):
-    global has_front
+    global snapshot
+    scanner = snapshot.scanners[scanner_name]
     with globals_lock:
-        scanner = global_scanner_dict[scanner_name]
-        has_front.discard(scanner.device_name)
+        snapshot = replace(
+            snapshot, has_front=snapshot.has_front - {scanner.device_name}
+        )
     return templates.TemplateResponse(
         request=request,
         name="scanoptions.html",
-        context={"scanner": scanner, "SANE_TYPE": SaneType, 'config': config},
+        context={"scanner": scanner},
     )
-
-
-# Read the scanners on startup - this takes some time,
-# the application won't respond until the scan is done
-update_scanners()
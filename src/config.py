@@ -1,7 +1,10 @@
 from pathlib import Path
-from pydantic import BaseModel, DirectoryPath, NonNegativeInt
+from pydantic import BaseModel, ConfigDict, DirectoryPath, NonNegativeInt
 
 class Config(BaseModel):
+    # a single instance is shared by all requests, so it must not be mutated
+    model_config = ConfigDict(frozen=True)
+
     scandir: DirectoryPath
     preferred_resolution: NonNegativeInt
     preferred_mode: str
@@ -1,10 +1,15 @@
 import logging
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
+from dataclasses import dataclass, fields
 from enum import IntEnum
 from datetime import datetime
+from io import BytesIO
 from pathlib import Path
-from tempfile import TemporaryDirectory
-from pydantic import BaseModel, Field, NonNegativeInt, PositiveInt
+from tempfile import NamedTemporaryFile
+from pydantic import BaseModel, Field, PositiveInt
 
 import pymupdf
 import sane
@@ -12,6 +17,8 @@ from PIL import Image
 
 from config import config
 
+logger = logging.getLogger(__name__)
+
 class SaneType(IntEnum):
     BOOL = 0
     INT = 1
@@ -20,19 +27,23 @@ class SaneType(IntEnum):
     BUTTON = 4
     GROUP = 5
 
-class SaneScannerOption(BaseModel):
-    index: NonNegativeInt
+# The scanner descriptions are built from data reported by SANE and only read by
+# the templates, so they use plain dataclasses instead of validating models.
+@dataclass(frozen=True, slots=True)
+class SaneScannerOption:
+    index: int
     name: str|None
     title: str
     desc: str|None
-    type: NonNegativeInt
-    unit: NonNegativeInt
-    size: NonNegativeInt
-    cap: NonNegativeInt
-    constraint: None|tuple[NonNegativeInt, NonNegativeInt, NonNegativeInt]|list[int]|list[float]|list[str]
+    type: int
+    unit: int
+    size: int
+    cap: int
+    constraint: None|tuple[int, int, int]|list[int]|list[float]|list[str]
 
 
-class SaneScanner(BaseModel):
+@dataclass(frozen=True, slots=True)
+class SaneScanner:
     device_name: str
     vendor: str
     model: str
@@ -46,29 +57,16 @@ class ScanOptions(BaseModel):
     mode: str
     filename: str = Field(default="")
 
-scanners: dict[str, SaneScanner] = {}
 isBusy: set[str] = set()
 
 def list_scanners() -> dict[str, SaneScanner]:
     devices = {}
     for device in sane.get_devices():
         device_name, vendor, model, type_info = device
-        options = []
         try:
             with sane.SaneDev(device_name) as scanner:
-                for o in scanner.get_options():
-                    idx, name, title, desc, type_, unit, size, cap, constraint = o
-                    options.append(SaneScannerOption(
-                        index=idx,
-                        name=name,
-                        title=title,
-                        desc=desc,
-                        type=type_,
-                        unit=unit,
-                        size=size,
-                        cap=cap,
-                        constraint=constraint,
-                    ))
+                # the fields of SaneScannerOption follow the order of the option tuples
+                options = [SaneScannerOption(*o) for o in scanner.get_options()]
 
             devices[device_name] = SaneScanner(
                 device_name=device_name,
@@ -78,30 +76,71 @@ def list_scanners() -> dict[str, SaneScanner]:
                 options=options,
             )
         except Exception as e:
-            logging.error(e)
+            logger.error(e)
+    return devices
+
+
+SCANNER_CACHE = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'simple-webscan' / 'scanners.pkl'
+# stored next to the scanners, a cache written with a different layout of the
+# dataclasses is ignored instead of unpickling objects with missing attributes
+SCANNER_CACHE_FORMAT = (
+    tuple(f.name for f in fields(SaneScanner)),
+    tuple(f.name for f in fields(SaneScannerOption)),
+)
+
+def load_cached_scanners() -> dict[str, SaneScanner]|None:
+    try:
+        with SCANNER_CACHE.open('rb') as f:
+            cache_format, devices = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logger.warning("could not read scanner cache %s: %s", SCANNER_CACHE, e)
+        return None
+    if cache_format != SCANNER_CACHE_FORMAT:
+        logger.info("ignoring outdated scanner cache %s", SCANNER_CACHE)
+        return None
     return devices
 
 
-def process_page(tmpdir: Path, output: pymupdf.Document, scan: Image.Image, n=0):
-    print(f'scanned page {n}')
-    path = tmpdir / f'scan_{n}.jpg'
-    scan.save(path, optimize=True, subsampling=0, quality=95)
-    with closing(img := pymupdf.open(path)):
-        rect = img[0].rect
-        pdfbytes = img.convert_to_pdf()
-    imgPDF = pymupdf.open('pdf', pdfbytes)
-    page = output.new_page(width = rect.width, height = rect.height) # type: ignore
-    page.show_pdf_page(rect, imgPDF, 0)
+def save_cached_scanners(devices: dict[str, SaneScanner]):
+    try:
+        SCANNER_CACHE.parent.mkdir(parents=True, exist_ok=True)
+        # write to a temporary file and move it into place, so concurrent updates
+        # or a crash never leave a partially written cache behind
+        with NamedTemporaryFile('wb', dir=SCANNER_CACHE.parent, prefix=SCANNER_CACHE.name, delete=False) as f:
+            tmp = Path(f.name)
+            try:
+                pickle.dump((SCANNER_CACHE_FORMAT, devices), f)
+            except BaseException:
+                tmp.unlink()
+                raise
+        try:
+            tmp.replace(SCANNER_CACHE)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+    except OSError as e:
+        logger.warning("could not write scanner cache %s: %s", SCANNER_CACHE, e)
+
+
+def process_page(output: pymupdf.Document, scan: Image.Image, resolution: int, n=0):
+    logger.debug('scanned page %d', n)
+    jpeg = BytesIO()
+    scan.save(jpeg, format='JPEG', subsampling=0, quality=95)
+    # the page size in points is given by the scanned area and the resolution
+    page = output.new_page(width=scan.width * 72 / resolution, height=scan.height * 72 / resolution) # type: ignore
+    page.insert_image(page.rect, stream=jpeg.getvalue(), keep_proportion=False)
 
 
 def scan(options: ScanOptions) -> Path|None:
-    print(f"scan with {options.scanner}")
-    with TemporaryDirectory() as tmp, closing(output := pymupdf.open()), sane.SaneDev(options.scanner) as scanner:
-        print(f"scanner {options.scanner} opened")
-        tmpdir = Path(tmp)
+    logger.debug("scan with %s", options.scanner)
+    with closing(output := pymupdf.open()), sane.SaneDev(options.scanner) as scanner:
+        logger.debug("scanner %s opened", options.scanner)
         scanner.source = options.source
         scanner.resolution = options.resolution
         scanner.mode = options.mode
+        resolution = scanner.resolution
         target = Path(options.filename if options.filename else f'Scan_{datetime.now():%Y-%m-%d_%H_%M_%S}.pdf').resolve()
         target = Path(target.name)
         if not target.suffix == '.pdf':
@@ -109,15 +148,24 @@ def scan(options: ScanOptions) -> Path|None:
 
         scan: Image.Image
         if options.source == 'ADF':
-            for n, scan in enumerate(scanner.multi_scan()):
-                process_page(tmpdir, output, scan, n)
+            # encode page n while the scanner feeds page n + 1, a single worker
+            # keeps the pages in order and the output document on one thread
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                page = None
+                for n, scan in enumerate(scanner.multi_scan()):
+                    # stop feeding paper as soon as the previous page failed
+                    if page is not None:
+                        page.result()
+                    page = executor.submit(process_page, output, scan, resolution, n)
+                if page is not None:
+                    page.result()
         else:
             scan = scanner.scan()
-            process_page(tmpdir, output, scan)
+            process_page(output, scan, resolution)
             
         if output.page_count:
             output.save(config.scandir / target)
             return Path(target)
         else:
-            print("no pages were scanned")
+            logger.info("no pages were scanned")
             return None